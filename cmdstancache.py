@@ -1,16 +1,20 @@
 """CmdStanCache caches Stan MCMC runs."""
 import os
-import glob
 import joblib
 import numpy as np
 import hashlib
 import re
 import tempfile
-import shutil
 import warnings
 import collections
 
-import cmdstanpy
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+if xxhash is not None and not hasattr(xxhash, 'xxh3_128'):
+	# xxh3 is only available from xxhash 2.0
+	xxhash = None
 
 __author__ = """Johannes Buchner"""
 __email__ = 'johannes.buchner.acad@gmx.com'
@@ -21,6 +25,9 @@ mem = joblib.Memory(path, verbose=False)
 
 __all__ = ["mem", "get_path", "clear", "run_stan"]
 
+# hashes of the data json files written in this session, by data fingerprint
+known_data_hashes = {}
+
 
 def get_path():
 	"""Get path of the cache."""
@@ -31,11 +38,17 @@ def clear():
 	"""Clear cache of models, data and runs."""
 	# clear joblib memory
 	mem.clear()
-	# glob all the cache files
-	files = glob.glob(os.path.join(get_path(), "*.json"))
-	files += glob.glob(os.path.join(get_path(), "*.stan"))
-	for f in files:
-		os.remove(f)
+	if not os.path.isdir(get_path()):
+		return
+	# remove all the cache files, in one pass over the directory
+	for entry in list(os.scandir(get_path())):
+		if entry.name.endswith(('.json', '.stan')) and entry.is_file():
+			os.remove(entry.path)
+
+
+COMMENT_PATTERN = re.compile(r'//.*$', re.MULTILINE)
+WHITESPACE_PATTERN = re.compile(r'[ \t]+')
+NONASCII_PATTERN = re.compile(r'[^\x00-\x7f]')
 
 
 def trim_model_code(code):
@@ -51,34 +64,57 @@ def trim_model_code(code):
 	code: str
 		Trimmed, normalised code
 	"""
-	lines = code.split("\n")
-	code_lines = [re.sub('//.*$', '', line).strip() for line in lines]
+	lines = COMMENT_PATTERN.sub('', code).split("\n")
+	code_lines = [line.strip() for line in lines]
 	code_lines_singlespace = [
-		line.replace('    ', ' ').replace('  ', ' ').replace('  ', ' ')
+		WHITESPACE_PATTERN.sub(' ', line)
 		for line in code_lines if len(line) > 0]
 
 	slimcode = '\n'.join(code_lines_singlespace).strip()
-	slimbytes = slimcode.encode(encoding="ascii", errors="ignore")
-	slimcode_ascii = slimbytes.decode(encoding="ascii")
+	slimcode_ascii = NONASCII_PATTERN.sub('', slimcode)
 	return slimcode_ascii
 
 
-def hash_model_code(code):
+def new_hash(legacy=False):
+	"""Create a hash object for computing cache keys.
+
+	The hash is not used for security, so the fast xxh3_128 is used
+	if the xxhash package is installed, otherwise md5.
+
+	Parameters
+	----------
+	legacy: bool
+		whether to use md5 regardless, as older versions of cmdstancache did.
+
+	Returns
+	-------
+	hash: object
+		hash object, with update() and hexdigest() methods
+	"""
+	if xxhash is None or legacy:
+		return hashlib.md5()
+	return xxhash.xxh3_128()
+
+
+def hash_model_code(code, legacy=False):
 	"""Get a hash for stan code.
 
 	Parameters
 	----------
 	code: str
 		Stan code
+	legacy: bool
+		whether to compute the md5 hash used by older versions.
 
 	Returns
 	-------
 	hash: str
-		md5 hash
+		hex digest
 	"""
 	slimbytes = code.encode(encoding="ascii")
-	hexcode = hashlib.md5(slimbytes).hexdigest()
-	return hexcode
+	hasher = new_hash(legacy=legacy)
+	hasher.update(slimbytes)
+	return hasher.hexdigest()
 
 
 def hash_data(datafile):
@@ -92,19 +128,154 @@ def hash_data(datafile):
 	Returns
 	-------
 	hash: str
-		md5 hash
+		hex digest
 	"""
-	BUF_SIZE = 1024 * 1024
-	md5 = hashlib.md5()
+	BUF_SIZE = 16 * 1024 * 1024
+	hasher = new_hash()
 
 	with open(datafile, 'rb') as f:
+		# small files are read in one go, large files in big chunks
+		# into a single, re-used buffer
+		buf = memoryview(bytearray(min(BUF_SIZE, max(os.fstat(f.fileno()).st_size, 1))))
 		while True:
-			data = f.read(BUF_SIZE)
-			if not data:
+			n = f.readinto(buf)
+			if not n:
 				break
-			md5.update(data)
+			hasher.update(buf[:n])
+
+	return hasher.hexdigest()
+
+
+def is_plain_data(value):
+	"""Check whether a data value is a number, array, or (nested) list of these.
+
+	Tuples are excluded, because cmdstanpy writes them as Stan tuples,
+	not as arrays.
+
+	Parameters
+	----------
+	value: object
+		Model data value
 
-	return md5.hexdigest()
+	Returns
+	-------
+	plain: bool
+		whether the value is plain
+	"""
+	stack = [value]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, list):
+			stack.extend(item)
+		elif not isinstance(item, (np.ndarray, np.generic, bool, int, float)):
+			return False
+	return True
+
+
+def fingerprint_data(data):
+	"""Get a quick fingerprint of in-memory model data.
+
+	The fingerprint is computed from the type, shape and raw bytes of
+	each value, which is much faster than writing and hashing the json.
+
+	Parameters
+	----------
+	data: dict
+		Model data, sorted by key
+
+	Returns
+	-------
+	fingerprint: str or None
+		hex digest, or None if the data contain values which are not
+		plain numeric or bool scalars, arrays or lists (e.g., ragged lists or tuples).
+	"""
+	hasher = new_hash()
+	for k, v in data.items():
+		if not is_plain_data(v):
+			return None
+		try:
+			v = np.asarray(v)
+		except ValueError:
+			return None
+		if v.dtype.kind not in 'biuf':
+			return None
+		# ndim and shape distinguish scalars from length-1 lists
+		hasher.update(repr((k, v.dtype.str, v.ndim, v.shape)).encode())
+		hasher.update(v.ravel().view(np.uint8))
+	return hasher.hexdigest()
+
+
+def write_data(data):
+	"""Store model data as json in the cache directory.
+
+	Parameters
+	----------
+	data: dict
+		Model data, sorted by key
+
+	Returns
+	-------
+	data_hash: str
+		hash of the json file, which is stored as <data_hash>.json
+	"""
+	import cmdstanpy
+
+	# write into the cache directory, so the file can be renamed
+	# to its final name, instead of copied
+	with tempfile.NamedTemporaryFile(dir=path, suffix='.json', delete=False) as f:
+		fname = f.name
+	try:
+		cmdstanpy.write_stan_json(fname, data)
+		data_hash = hash_data(fname)
+		datafile = os.path.join(path, data_hash + '.json')
+		if os.path.exists(datafile):
+			# same content is already there
+			os.unlink(fname)
+		else:
+			os.replace(fname, datafile)
+	except BaseException:
+		os.unlink(fname)
+		raise
+	return data_hash
+
+
+def write_code(code, code_hash):
+	"""Store stan code in the cache directory, unless it is already there.
+
+	Parameters
+	----------
+	code: str
+		Stan code
+	code_hash: str
+		hash of the code, as computed by `hash_model_code`
+
+	Returns
+	-------
+	codefile: str
+		Path to the code file
+	"""
+	codefile = os.path.join(path, 'H%s.stan' % code_hash)
+	if xxhash is not None and not os.path.exists(codefile):
+		# re-use code files (and their compiled models) stored under the md5 name
+		legacy_codefile = os.path.join(path, 'H%s.stan' % hash_model_code(code, legacy=True))
+		if os.path.exists(legacy_codefile):
+			codefile = legacy_codefile
+	# write missing code files, or files left incomplete by an interrupted write,
+	# via a temporary file, so the code file appears atomically
+	codebytes = code.encode(encoding="ascii")
+	if not os.path.exists(codefile) or os.path.getsize(codefile) != len(codebytes):
+		# the temporary name is unique per thread and process, and ends in .stan,
+		# so files left by a killed process are removed by clear()
+		fd, tmpfile = tempfile.mkstemp(dir=path, prefix='tmp', suffix='.stan')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(codebytes)
+			os.replace(tmpfile, codefile)
+		except BaseException:
+			if os.path.exists(tmpfile):
+				os.unlink(tmpfile)
+			raise
+	return codefile
 
 
 def get_formatted_code(code):
@@ -120,25 +291,33 @@ def get_formatted_code(code):
 	formatted_code: str
 		Stan code
 	"""
-	formatted_code_lines = []
+	lines = code.split("\n")
+	formatted_code_lines = [None] * len(lines)
 	indent = 0
-	for i, line in enumerate(code.split("\n")):
+	for i, line in enumerate(lines):
 		indent -= line.count('}')
-		formatted_code_lines.append('%3d: %s%s' % (i + 1, '  ' * indent, line))
+		formatted_code_lines[i] = '%3d: %s%s' % (i + 1, '  ' * indent, line)
 		indent += line.count('{')
 	return '\n'.join(formatted_code_lines)
 
 
-@mem.cache(ignore=['verbose', 'show_console'])
-def cached_run_stan(code, datafile, verbose=True, show_console=False, **kwargs):
+@mem.cache(ignore=['code', 'data', 'verbose', 'show_console'])
+def cached_run_stan(code_hash, data_hash, code, data=None, verbose=True, show_console=False, **kwargs):
 	"""Run MCMC with the given code and data file.
 
+	Only the hashes (and the sampling arguments) identify a run, so joblib
+	does not need to pickle and hash the full code on each call.
+
 	Parameters
 	----------
+	code_hash: str
+		hash of the code, as computed by `hash_model_code`
+	data_hash: str
+		hash of the data file <data_hash>.json in the cache directory
 	code: str
 		Stan model code
-	datafile: str
-		Path to data file
+	data: dict
+		Model data, sorted by key, used to write the data file if it is missing.
 	verbose: bool
 		whether to print the code being compiled, posterior summaries and diagnostics.
 	**kwargs: dict
@@ -155,15 +334,21 @@ def cached_run_stan(code, datafile, verbose=True, show_console=False, **kwargs):
 		print("Code")
 		print("----")
 		print(get_formatted_code(code))
-	code_hash = hash_model_code(code)
-	codefile = os.path.join(path, 'H%s.stan' % code_hash)
-	if not os.path.exists(codefile):
-		with open(codefile, 'w') as f:
-			f.write(code)
+	codefile = write_code(code, code_hash)
+	import cmdstanpy
 	model = cmdstanpy.CmdStanModel(stan_file=codefile)
-	assert model.code() == code, (model.code, code)
 
-	fit = model.sample(data=datafile, show_console=show_console, **kwargs)
+	datafile = os.path.join(path, data_hash + '.json')
+	# run_stan skips writing the data file if the run is cached, but joblib
+	# recomputes the run if the cached results cannot be loaded
+	data_written = data is not None and not os.path.exists(datafile)
+	if data_written:
+		write_data(data)
+	try:
+		fit = model.sample(data=datafile, show_console=show_console, **kwargs)
+	finally:
+		if data_written:
+			os.unlink(datafile)
 	if verbose:
 		print("Summary")
 		print("-------")
@@ -175,6 +360,35 @@ def cached_run_stan(code, datafile, verbose=True, show_console=False, **kwargs):
 	return fit.stan_variables(), fit.method_variables()
 
 
+def data_file_needed(code_hash, data_hash, code, **kwargs):
+	"""Check whether the data file has to be written for a run.
+
+	Parameters
+	----------
+	code_hash: str
+		hash of the code, as computed by `hash_model_code`
+	data_hash: str or None
+		hash of the data json, or None if not known yet
+	code: str
+		Stan model code
+	**kwargs: dict
+		arguments passed on to `cached_run_stan`
+
+	Returns
+	-------
+	needed: bool
+		whether the data file needs to be written (and removed after the run).
+	"""
+	if data_hash is None:
+		# data not seen before: write the data file to learn its hash
+		return True
+	if os.path.exists(os.path.join(path, data_hash + '.json')):
+		# data file is already there
+		return False
+	# the data file is only needed if the run is not cached
+	return not cached_run_stan.check_call_in_cache(code_hash, data_hash, code, **kwargs)
+
+
 def run_stan(code, data, verbose=True, **kwargs):
 	"""Run MCMC with the given code and data.
 
@@ -198,6 +412,7 @@ def run_stan(code, data, verbose=True, **kwargs):
 		method_variables returned by fit object
 	"""
 	simple_model_code = trim_model_code(code)
+	code_hash = hash_model_code(simple_model_code)
 
 	if verbose:
 		print()
@@ -213,22 +428,23 @@ def run_stan(code, data, verbose=True, **kwargs):
 				print('  %-10s: shape %s [%s ... %s]' % (k, shape, np.min(v), np.max(v)))
 			del k, v
 
-	with tempfile.NamedTemporaryFile(suffix='.json') as f:
-		fname = f.name
-		data_sorted = {k: data[k] for k in sorted(data.keys())}
-		cmdstanpy.write_stan_json(fname, data_sorted)
-		del data_sorted
-		data_hash = hash_data(fname)
+	data_sorted = {k: data[k] for k in sorted(data.keys())}
+	fingerprint = fingerprint_data(data_sorted)
+	data_hash = known_data_hashes.get(fingerprint)
+	written = data_file_needed(code_hash, data_hash, simple_model_code, verbose=verbose, **kwargs)
+	if written:
+		data_hash = write_data(data_sorted)
+		if fingerprint is not None:
+			known_data_hashes[fingerprint] = data_hash
 
-		datafile = os.path.join(path, data_hash + '.json')
-		shutil.copy(fname, datafile)
+	results = cached_run_stan(code_hash, data_hash, simple_model_code, data=data_sorted, verbose=verbose, **kwargs)
+	del data_sorted
 
-	results = cached_run_stan(simple_model_code, datafile, verbose=verbose, **kwargs)
-
-	try:
-		os.unlink(datafile)
-	except IOError as e:
-		warnings.warn('Cleaning up stan input data file failed: %s' % e)
+	if written:
+		try:
+			os.unlink(os.path.join(path, data_hash + '.json'))
+		except IOError as e:
+			warnings.warn('Cleaning up stan input data file failed: %s' % e)
 
 	return results
 
@@ -248,6 +464,8 @@ def remove_stuck_chains(stan_variables, method_variables):
 	-------
 	stan_variables: dict
 		Dictionary of variables with their posterior chains.
+		If no chains are removed, these are the input arrays themselves,
+		not copies, so modifying them in place also modifies the input.
 	"""
 	# identify the likelihood range of each chain
 	# select the chain with the highest likelihood
@@ -255,20 +473,22 @@ def remove_stuck_chains(stan_variables, method_variables):
 	# Chains stuck with very poor solutions will be removed
 	lp = method_variables['lp__']
 
-	top_chain_index = np.argmax(lp.max(axis=0))
+	chain_max_lp = lp.max(axis=0)
+	top_chain_index = np.argmax(chain_max_lp)
 	top_chain_min_lp = lp[:, top_chain_index].min()
-	chain_mask = lp.max(axis=0) > top_chain_min_lp
-	if not chain_mask.all():
-		warnings.warn("Ignoring these stuck chains: %s" % (np.where(~chain_mask)[0] + 1))
+	chain_mask = chain_max_lp > top_chain_min_lp
+	if chain_mask.all():
+		# no chains to remove, so the draws do not need to be copied
+		return collections.OrderedDict(stan_variables)
+	warnings.warn("Ignoring these stuck chains: %s" % (np.where(~chain_mask)[0] + 1))
 
 	chain_length, num_chains = lp.shape
-	mask = np.zeros(lp.size, dtype=bool)
-	for i in np.where(chain_mask)[0]:
-		mask[i * chain_length: (i + 1) * chain_length] = True
 
-	filtered_variables = collections.OrderedDict()
-	for k, v in stan_variables.items():
-		filtered_variables[k] = v[mask, ...]
+	# draws are stored chain after chain, so select whole chains
+	# as contiguous blocks
+	filtered_variables = collections.OrderedDict(
+		(k, v.reshape((num_chains, chain_length) + v.shape[1:])[chain_mask].reshape((-1,) + v.shape[1:]))
+		for k, v in stan_variables.items())
 
 	return filtered_variables
 
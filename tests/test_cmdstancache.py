@@ -4,7 +4,7 @@ import glob
 import matplotlib.pyplot as plt
 import tempfile
 import cmdstancache
-from cmdstancache import clear, run_stan, get_path, plot_corner, remove_stuck_chains
+from cmdstancache import clear, run_stan, get_path, plot_corner, remove_stuck_chains, trim_model_code
 
 def test_cache():
 	# use a temporary directory for running the test
@@ -75,6 +75,99 @@ model {
 	assert len(data_files) == 0
 	del data_files, code_files
 
+def test_clear_missing_dir():
+	oldpath = cmdstancache.path
+	with tempfile.TemporaryDirectory() as d:
+		cmdstancache.path = os.path.join(d, 'missing')
+		try:
+			clear()
+		finally:
+			cmdstancache.path = oldpath
+
+def test_trim_model_code():
+	code = """
+data {
+  // dimensionality:
+  int     N;  // number of dimensions
+}
+model {
+		target += -2 *	  square(x[1]);
+}
+"""
+	assert trim_model_code(code) == "data {\nint N;\n}\nmodel {\ntarget += -2 * square(x[1]);\n}"
+
+def test_data_hash_scalar_vs_list():
+	assert cmdstancache.fingerprint_data(dict(N=5)) != cmdstancache.fingerprint_data(dict(N=[5]))
+	assert cmdstancache.fingerprint_data(dict(N=5)) != cmdstancache.fingerprint_data(dict(N=5.0))
+	assert cmdstancache.fingerprint_data(dict(N=[[1], [1, 2]])) is None
+	# tuples are written as Stan tuples, not as arrays
+	assert cmdstancache.fingerprint_data(dict(x=[1, 2.5])) is not None
+	assert cmdstancache.fingerprint_data(dict(x=(1, 2.5))) is None
+	assert cmdstancache.fingerprint_data(dict(x=[(1, 2.5)])) is None
+
+	oldpath = cmdstancache.path
+	with tempfile.TemporaryDirectory() as d:
+		cmdstancache.path = d
+		try:
+			assert cmdstancache.write_data(dict(N=5)) != cmdstancache.write_data(dict(N=[5]))
+			assert cmdstancache.write_data(dict(x=[1, 2.5])) != cmdstancache.write_data(dict(x=(1, 2.5)))
+		finally:
+			cmdstancache.path = oldpath
+
+class FakeFit(object):
+	def stan_variables(self):
+		return dict(x=np.zeros(4000))
+
+	def method_variables(self):
+		return dict(lp__=np.zeros((1000, 4)))
+
+class FakeModel(object):
+	datafiles = []
+
+	def __init__(self, stan_file):
+		assert os.path.exists(stan_file)
+
+	def sample(self, data, show_console=False, **kwargs):
+		assert os.path.exists(data)
+		FakeModel.datafiles.append(data)
+		return FakeFit()
+
+def test_run_stan_data_file(monkeypatch):
+	import joblib
+	import cmdstanpy
+	code = "parameters {\n  real x;\n}\nmodel {\n  x ~ normal(0, 1);\n}\n"
+	FakeModel.datafiles = []
+	with tempfile.TemporaryDirectory() as d:
+		monkeypatch.setattr(cmdstancache, 'path', d)
+		monkeypatch.setattr(cmdstanpy, 'CmdStanModel', FakeModel)
+		monkeypatch.setattr(cmdstancache, 'known_data_hashes', {})
+		cached_run_stan = joblib.Memory(os.path.join(d, 'joblib'), verbose=False).cache(
+			ignore=cmdstancache.cached_run_stan.ignore)(cmdstancache.cached_run_stan.func)
+		monkeypatch.setattr(cmdstancache, 'cached_run_stan', cached_run_stan)
+
+		# new data: the data file is written, used and removed
+		run_stan(code, dict(N=2), verbose=False)
+		assert len(FakeModel.datafiles) == 1
+		assert glob.glob(os.path.join(d, "*.json")) == []
+		assert len(glob.glob(os.path.join(d, "*.stan"))) == 1
+
+		written = []
+		write_data = cmdstancache.write_data
+		monkeypatch.setattr(cmdstancache, 'write_data', lambda data: written.append(data) or write_data(data))
+
+		# cached run with known data: no data file is needed
+		run_stan(code, dict(N=2), verbose=False)
+		assert len(FakeModel.datafiles) == 1
+		assert written == []
+
+		# run considered cached, but recomputed by joblib: the data file is written
+		cached_run_stan.clear()
+		monkeypatch.setattr(cached_run_stan, 'check_call_in_cache', lambda *args, **kwargs: True)
+		run_stan(code, dict(N=2), verbose=False)
+		assert len(FakeModel.datafiles) == 2
+		assert len(written) == 1
+		assert glob.glob(os.path.join(d, "*.json")) == []
+
 def test_plot1var():
 	stan_variables, method_variables = run_stan("""
 data {
@@ -106,6 +199,17 @@ def test_clean_stuck_chains():
 	np.testing.assert_equal(cleaned_variables['myvar1'], stan_variables['myvar1'][expected_mask])
 	np.testing.assert_equal(cleaned_variables['myvar2'], stan_variables['myvar2'][expected_mask])
 
+def test_clean_no_stuck_chains():
+	method_variables = dict(lp__ = np.random.normal(size=(1000,4)))
+	stan_variables = dict(myvar1 = np.random.normal(size=4000), myvar2 = np.random.normal(size=(4000, 3)))
+
+	cleaned_variables = remove_stuck_chains(stan_variables, method_variables)
+
+	assert cleaned_variables.keys() == set(['myvar1', 'myvar2'])
+	# no chains removed: the arrays are returned without copying
+	assert cleaned_variables['myvar1'] is stan_variables['myvar1']
+	assert cleaned_variables['myvar2'] is stan_variables['myvar2']
+
 def test_plot_cleaned():
 	stan_variables, method_variables = run_stan("""
 parameters {